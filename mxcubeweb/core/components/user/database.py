@@ -1,7 +1,7 @@
 import datetime
 import typing
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from flask_security import SQLAlchemySessionUserDatastore
@@ -17,9 +17,36 @@ def init_db(path):
     Base.query = db_session.query_property()
     Base.metadata.create_all(bind=engine)
 
+    # create_all does not alter existing tables, make sure that databases
+    # created before a column or an index was introduced get it as well
+    _add_proposal_prefix_column(engine)
+
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
     return db_session
 
 
+def _add_proposal_prefix_column(engine):
+    columns = {column["name"] for column in inspect(engine).get_columns("user")}
+
+    if "proposal_prefix" in columns:
+        return
+
+    with engine.begin() as conn:
+        conn.execute(text('ALTER TABLE "user" ADD COLUMN proposal_prefix VARCHAR(255)'))
+        # Existing usernames are either <login id> or <login id>-<uuid>
+        conn.execute(
+            text(
+                'UPDATE "user" SET proposal_prefix = CASE'
+                " WHEN instr(username, '-') > 0"
+                " THEN substr(username, 1, instr(username, '-') - 1)"
+                " ELSE username END"
+            )
+        )
+
+
 class UserDatastore(SQLAlchemySessionUserDatastore):
     """A UserDatastore implementation that assumes the
     use of
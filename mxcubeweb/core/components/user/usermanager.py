@@ -2,102 +2,184 @@ import logging
 import json
 import uuid
 import datetime
+import time
 
 import flask
 import flask_security
 from flask_login import current_user
+from sqlalchemy import select, update
+from sqlalchemy.orm import selectinload
 
 from mxcubeweb.core.components.component_base import ComponentBase
-from mxcubeweb.core.models.usermodels import User
+from mxcubeweb.core.models.usermodels import User, Role
 from mxcubeweb.core.util.networkutils import is_local_host, remote_addr
 from mxcubeweb.core.util.convertutils import convert_to_dict
 
 from mxcubecore import HardwareRepository as HWR
 
+# Minimum time in seconds between two update_operator calls from login_info
+OPERATOR_UPDATE_INTERVAL = 5
+
+
+def _proposal_list(lims_data):
+    lims_data = convert_to_dict(lims_data)
+
+    return [
+        {
+            "code": prop["Proposal"]["code"],
+            "number": prop["Proposal"]["number"],
+            "proposalId": prop["Proposal"]["proposalId"],
+            "title": prop["Proposal"]["title"],
+            "person": prop["Person"].get("familyName", ""),
+        }
+        for prop in lims_data.get("proposalList", [])
+    ]
+
+
+def _cached_current_user():
+    # Resolve the flask_login proxy only once per request
+    if "_mx_user" not in flask.g:
+        flask.g._mx_user = current_user._get_current_object()
+
+    return flask.g._mx_user
+
+
+def _clear_cached_current_user():
+    flask.g.pop("_mx_user", None)
+    _clear_cached_is_operator()
+
+
+def _clear_cached_is_operator():
+    flask.g.pop("_mx_is_operator", None)
+
 
 class BaseUserManager(ComponentBase):
     def __init__(self, app, config):
         super().__init__(app, config)
+        self._inhouse_ids_cache = (None, frozenset())
+        self._user_role_map = {}
+        self._roles_cache = {}
+        self._operator_updated_at = 0
 
-    def get_observers(self):
-        return [
-            user
-            for user in User.query.all()
-            if ((not user.in_control) and user.is_authenticated and user.is_active)
-        ]
+        for _u in self.config.users:
+            self._user_role_map.setdefault(_u.username, _u.role)
 
-    def get_operator(self):
-        user = None
+    def get_observers(self):
+        stmt = (
+            select(User)
+            .where(User.active.is_(True), User.in_control.is_not(True))
+            .options(selectinload(User.roles))
+        )
 
-        for _u in User.query.all():
-            if _u.in_control:
-                user = _u
-                break
+        return list(self.app.server.db_session.scalars(stmt))
 
-        return user
+    def get_operator(self):
+        stmt = select(User).filter_by(in_control=True).limit(1)
+        return self.app.server.db_session.scalars(stmt).first()
 
     def is_operator(self):
-        return getattr(current_user, "in_control", False)
+        if "_mx_is_operator" not in flask.g:
+            flask.g._mx_is_operator = getattr(
+                _cached_current_user(), "in_control", False
+            )
+
+        return flask.g._mx_is_operator
 
     def active_logged_in_users(self, exclude_inhouse=False):
         self.update_active_users()
 
+        stmt = select(User.username).where(User.active.is_(True))
+
         if exclude_inhouse:
-            users = [
-                _u.username for _u in User.query.all() if _u.active and not _u.isstaff
-            ]
-        else:
-            users = [_u.username for _u in User.query.all() if _u.active]
+            stmt = stmt.where(~User.roles.any(Role.name == "staff"))
+
+        return list(self.app.server.db_session.scalars(stmt))
+
+    def _exists(self, stmt):
+        return self.app.server.db_session.scalar(select(stmt.exists()))
+
+    def has_active_users(self):
+        return self._exists(select(User.id).where(User.active.is_(True)))
+
+    def has_active_operator(self):
+        return self._exists(
+            select(User.id).where(User.in_control.is_(True), User.active.is_(True))
+        )
+
+    def is_active_user(self, username):
+        return self._exists(select(User.id).filter_by(username=username, active=True))
+
+    def has_active_non_inhouse_proposal_conflict(self, login_id):
+        """
+        Returns True if there are active (non in-house) users and none of
+        them belongs to the proposal login_id
+        """
+        stmt = (
+            select(User.proposal_prefix)
+            .where(
+                User.active.is_(True),
+                User.proposal_prefix.is_not(None),
+                ~User.roles.any(Role.name == "staff"),
+            )
+            .distinct()
+        )
+        active_proposals = set(self.app.server.db_session.scalars(stmt))
 
-        return users
+        return bool(active_proposals) and login_id not in active_proposals
 
     def get_user(self, username):
-        user = None
+        stmt = select(User).filter_by(username=username)
+        return self.app.server.db_session.scalars(stmt).one_or_none()
 
-        for _u in User.query.all():
-            if _u.username == username:
-                user = _u
+    def set_operator(self, username):
+        self._db_set_operator(username)
+        self.app.server.user_datastore.commit()
+        _clear_cached_is_operator()
 
-        return user
+        return self.get_user(username)
 
-    def set_operator(self, username):
-        user = None
+    def update_active_users(self):
+        cutoff = datetime.datetime.now() - flask.current_app.permanent_session_lifetime
+        db_session = self.app.server.db_session
+        inactive = (User.active.is_(True), User.last_request_timestamp < cutoff)
+        stmt = update(User).where(*inactive).values(active=False)
+
+        if db_session.get_bind().dialect.update_returning:
+            stmt = stmt.returning(User.username, User.socketio_session_id)
+            inactive_users = db_session.execute(stmt).all()
+        else:
+            # UPDATE ... RETURNING is only available from SQLite 3.35
+            inactive_users = db_session.execute(
+                select(User.username, User.socketio_session_id).where(*inactive)
+            ).all()
+            db_session.execute(stmt)
 
-        for _u in User.query.all():
-            if _u.username == username:
-                self.db_set_in_control(_u, True)
-                user = _u
-            else:
-                self.db_set_in_control(_u, False)
+        self.app.server.user_datastore.commit()
 
-        return user
+        for username, _ in inactive_users:
+            logging.getLogger("HWR.MX3").info(f"Logged out inactive user {username}")
 
-    def update_active_users(self):
-        for _u in User.query.all():
-            if (
-                _u.active
-                and _u.last_request_timestamp
-                and (datetime.datetime.now() - _u.last_request_timestamp)
-                > flask.current_app.permanent_session_lifetime
-            ):
-                logging.getLogger("HWR.MX3").info(
-                    f"Logged out inactive user {_u.username}"
-                )
-                self.app.server.user_datastore.deactivate_user(_u)
-                self.app.server.emit(
-                    "userChanged", room=_u.socketio_session_id, namespace="/hwr"
-                )
+        # Notify all logged out users with one emit to their rooms
+        sids = [sid for _, sid in inactive_users if sid]
+
+        if sids:
+            self.app.server.emit("userChanged", to=sids, namespace="/hwr")
 
         self.app.server.emit("observersChanged", namespace="/hwr")
 
     def update_operator(self, new_login=False):
-        active_in_control = False
+        # Users that are no longer authenticated can not remain in control
+        result = self.app.server.db_session.execute(
+            update(User)
+            .where(User.in_control.is_(True), User.active.is_not(True))
+            .values(in_control=False)
+        )
+        self.app.server.user_datastore.commit()
 
-        for _u in User.query.all():
-            if _u.is_authenticated and _u.in_control:
-                active_in_control = True
-            else:
-                self.db_set_in_control(_u, False)
+        if result.rowcount:
+            _clear_cached_is_operator()
+
+        operator = self.get_operator()
 
         # If new login and new observer login, clear nickname
         # so that the user get an opertunity to set one
@@ -106,29 +188,46 @@ class BaseUserManager(ComponentBase):
 
         # If no user is currently in control set this user to be
         # in control
-        if not active_in_control:
-            if HWR.beamline.lims.loginType.lower() != "user":
+        if operator is None:
+            if self._login_type() != "user":
                 current_user.nickname = self.app.lims.get_proposal(current_user)
             else:
                 current_user.nickname = current_user.username
 
             self.db_set_in_control(current_user, True)
+            operator = current_user
 
         # Set active proposal to that of the active user
-        for _u in User.query.all():
-            if _u.is_authenticated and _u.in_control:
-                if HWR.beamline.lims.loginType.lower() != "user":
-                    self.app.lims.select_proposal(self.app.lims.get_proposal(_u))
-                elif _u.selected_proposal is not None:
-                    self.app.lims.select_proposal(_u.selected_proposal)
+        if self._login_type() != "user":
+            self.app.lims.select_proposal(self.app.lims.get_proposal(operator))
+        elif operator.selected_proposal is not None:
+            self.app.lims.select_proposal(operator.selected_proposal)
 
-    def is_inhouse_user(self, user_id):
-        user_id_list = [
-            "%s%s" % (code, number)
-            for (code, number) in HWR.beamline.session.in_house_users
-        ]
+        self._operator_updated_at = time.monotonic()
+
+    def _login_type(self):
+        # loginType is read through the hardware repository proxy, only
+        # look it up once per request
+        if "_mx_login_type" not in flask.g:
+            flask.g._mx_login_type = HWR.beamline.lims.loginType.lower()
+
+        return flask.g._mx_login_type
+
+    def _inhouse_ids(self):
+        in_house_users = HWR.beamline.session.in_house_users
+
+        # Rebuild the lookup set only when the session hands out a new list
+        if self._inhouse_ids_cache[0] is not in_house_users:
+            self._inhouse_ids_cache = (
+                in_house_users,
+                frozenset("%s%s" % prop for prop in in_house_users),
+            )
+            self._roles_cache.clear()
+
+        return self._inhouse_ids_cache[1]
 
-        return user_id in user_id_list
+    def is_inhouse_user(self, user_id):
+        return user_id in self._inhouse_ids()
 
     # Abstract method to be implemented by concrete implementation
     def _login(self, login_id, password):
@@ -141,7 +240,7 @@ class BaseUserManager(ComponentBase):
             raise
         else:
             if "sid" not in flask.session:
-                flask.session["sid"] = str(uuid.uuid4())
+                flask.session["sid"] = uuid.uuid4().hex
 
             # Making sure that the session of any in active users are invalideted
             # before calling login
@@ -149,6 +248,7 @@ class BaseUserManager(ComponentBase):
             user = self.db_create_user(login_id, password, login_res)
             self.app.server.user_datastore.activate_user(user)
             flask_security.login_user(user, remember=False)
+            _clear_cached_current_user()
 
             # Important to make flask_security user tracking work
             self.app.server.security.datastore.commit()
@@ -171,7 +271,7 @@ class BaseUserManager(ComponentBase):
 
     def signout(self):
         self._signout()
-        user = current_user
+        user = _cached_current_user()
 
         # If operator logs out clear queue and sample list
         if self.is_operator():
@@ -186,18 +286,19 @@ class BaseUserManager(ComponentBase):
 
             self.app.CURRENTLY_MOUNTED_SAMPLE = ""
 
-            self.db_set_in_control(current_user, False)
+            self.db_set_in_control(user, False)
 
             msg = "User %s signed out" % user.username
             logging.getLogger("MX3.HWR").info(msg)
 
         self.app.server.user_datastore.deactivate_user(user)
         flask_security.logout_user()
+        _clear_cached_current_user()
 
         self.app.server.emit("observersChanged", namespace="/hwr")
 
     def is_authenticated(self):
-        return current_user.is_authenticated()
+        return bool(_cached_current_user().is_authenticated)
 
     def force_signout_user(self, username):
         user = self.get_user(username)
@@ -209,30 +310,31 @@ class BaseUserManager(ComponentBase):
             self.app.server.emit("forceSignout", room=socketio_sid, namespace="/hwr")
 
     def login_info(self):
-        if not current_user.is_anonymous:
-            login_info = convert_to_dict(json.loads(current_user.limsdata))
+        user = _cached_current_user()
 
-            self.update_operator()
+        if not user.is_anonymous:
+            # login_info is polled frequently, only re-evaluate the operator
+            # when no active user is in control (the session of the operator
+            # might have expired) or the last update is getting old
+            if (
+                time.monotonic() - self._operator_updated_at > OPERATOR_UPDATE_INTERVAL
+                or not self.has_active_operator()
+            ):
+                self.update_operator()
 
-            proposal_list = [
-                {
-                    "code": prop["Proposal"]["code"],
-                    "number": prop["Proposal"]["number"],
-                    "proposalId": prop["Proposal"]["proposalId"],
-                    "title": prop["Proposal"]["title"],
-                    "person": prop["Person"].get("familyName", ""),
-                }
-                for prop in login_info.get("proposalList", [])
-            ]
+            # Users created before proposal_list was stored at login
+            if user.proposal_list is None:
+                user.proposal_list = _proposal_list(json.loads(user.limsdata))
+                self.update_user(user)
 
             res = {
                 "synchrotronName": HWR.beamline.session.synchrotron_name,
                 "beamlineName": HWR.beamline.session.beamline_name,
                 "loggedIn": True,
-                "loginType": HWR.beamline.lims.loginType.title(),
-                "proposalList": proposal_list,
+                "loginType": self._login_type().title(),
+                "proposalList": user.proposal_list,
                 "rootPath": HWR.beamline.session.get_base_image_directory(),
-                "user": current_user.todict(),
+                "user": user.todict(),
             }
 
             res["selectedProposal"] = "%s%s" % (
@@ -251,25 +353,31 @@ class BaseUserManager(ComponentBase):
         self.app.server.user_datastore.commit()
 
     def _get_configured_roles(self, user):
-        roles = set()
+        # Make sure that the cache is invalidated if in-house users changed
+        self._inhouse_ids()
+
+        if user not in self._roles_cache:
+            self._roles_cache[user] = tuple(self._compute_configured_roles(user))
+
+        # user_datastore.create_user modifies the list of roles in place
+        return list(self._roles_cache[user])
 
-        _ihs = ["%s%s" % prop for prop in HWR.beamline.session.in_house_users]
+    def _compute_configured_roles(self, user):
+        roles = set()
 
-        if self.config.inhouse_is_staff and user in _ihs:
+        if self.config.inhouse_is_staff and self.is_inhouse_user(user):
             roles.add("staff")
 
-        for _u in self.config.users:
-            if _u.username == user:
-                roles.add(_u.role)
-                break
+        if user in self._user_role_map:
+            roles.add(self._user_role_map[user])
 
         return list(roles)
 
     def db_create_user(self, user: str, password: str, lims_data: dict):
         sid = flask.session["sid"]
         user_datastore = self.app.server.user_datastore
-        username = f"{user}-{str(uuid.uuid4())}"
-        if HWR.beamline.lims.loginType.lower() == "user":
+        username = f"{user}-{uuid.uuid4().hex}"
+        if self._login_type() == "user":
             username = f"{user}"
 
         # Make sure that the roles staff and incontrol always
@@ -282,7 +390,7 @@ class BaseUserManager(ComponentBase):
         _u = user_datastore.find_user(username=username)
 
         if not _u:
-            if HWR.beamline.lims.loginType.lower() != "user":
+            if self._login_type() != "user":
                 selected_proposal = user
             else:
                 selected_proposal = None
@@ -293,11 +401,15 @@ class BaseUserManager(ComponentBase):
                 nickname=user,
                 session_id=sid,
                 selected_proposal=selected_proposal,
+                proposal_prefix=user,
                 limsdata=json.dumps(lims_data),
+                proposal_list=_proposal_list(lims_data),
                 roles=self._get_configured_roles(user),
             )
         else:
             _u.limsdata = json.dumps(lims_data)
+            _u.proposal_list = _proposal_list(lims_data)
+            _u.proposal_prefix = user
             user_datastore.append_roles(_u, self._get_configured_roles(user))
 
         self.app.server.user_datastore.commit()
@@ -308,19 +420,26 @@ class BaseUserManager(ComponentBase):
         user_datastore = self.app.server.user_datastore
 
         if control:
-            for _u in User.query.all():
-                if _u.username == user.username:
-                    _u.in_control = True
-                else:
-                    _u.in_control = False
-
-                user_datastore.put(_u)
+            self._db_set_operator(user.username)
         else:
             _u = user_datastore.find_user(username=user.username)
             _u.in_control = control
             user_datastore.put(_u)
 
         self.app.server.user_datastore.commit()
+        _clear_cached_is_operator()
+
+    def _db_set_operator(self, username):
+        # Make sure that the next login_info selects the proposal of the
+        # new operator
+        self._operator_updated_at = 0
+        db_session = self.app.server.db_session
+        db_session.execute(
+            update(User).where(User.username != username).values(in_control=False)
+        )
+        db_session.execute(
+            update(User).where(User.username == username).values(in_control=True)
+        )
 
 
 class UserManager(BaseUserManager):
@@ -338,9 +457,9 @@ class UserManager(BaseUserManager):
             "inhouse": inhouse,
         }
 
-        active_users = self.active_logged_in_users()
+        self.update_active_users()
 
-        if login_id in active_users:
+        if self.is_active_user(login_id):
             if current_user.is_anonymous:
                 self.force_signout_user(login_id)
             else:
@@ -357,24 +476,21 @@ class UserManager(BaseUserManager):
         if inhouse and not (inhouse and is_local_host()):
             raise Exception("In-house only allowed from localhost")
 
-        non_inhouse_active_users = self.active_logged_in_users(exclude_inhouse=True)
-
         # Only allow other users to log-in if they are from the same proposal
         # (making sure to exclude inhouse users who are always allowed to login)
         if (
             (not inhouse)
-            and non_inhouse_active_users
-            and (login_id not in [p.split("-")[0] for p in non_inhouse_active_users])
-            and HWR.beamline.lims.loginType.lower() != "user"
+            and self._login_type() != "user"
+            and self.has_active_non_inhouse_proposal_conflict(login_id)
         ):
             raise Exception("Another user is already logged in")
 
         # Only allow if no one else is logged in
         if not current_user.is_anonymous:
             if (
-                active_users
+                self.has_active_users()
                 and current_user.username != login_id
-                and HWR.beamline.lims.loginType.lower() == "user"
+                and self._login_type() == "user"
             ):
                 raise Exception("Another user is already logged in")
 
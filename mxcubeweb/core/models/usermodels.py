@@ -10,6 +10,7 @@ from sqlalchemy import (
     Unicode,
     DateTime,
     Column,
+    Index,
     Integer,
     String,
     ForeignKey,
@@ -51,9 +52,10 @@ class Message(Base):
 
 class User(Base, UserMixin):
     __tablename__ = "user"
+    __table_args__ = (Index("ix_user_active_lrt", "active", "last_request_timestamp"),)
     id = Column(Integer, primary_key=True)
     email = Column(String(255), unique=True)
-    username = Column(Unicode, unique=True, nullable=True)
+    username = Column(Unicode, unique=True, nullable=True, index=True)
     nickname = Column(String(255), unique=False)
     password = Column(String(255), nullable=False)
     session_id = Column(String(255), unique=False)
@@ -68,8 +70,9 @@ class User(Base, UserMixin):
     confirmed_at = Column(DateTime())
     requests_control = Column(Boolean(False))
     requests_control_msg = Column(String(255))
-    in_control = Column(Boolean(False))
+    in_control = Column(Boolean(False), index=True)
     selected_proposal = Column(String(255), unique=False)
+    proposal_prefix = Column(String(255), unique=False, index=True)
     proposal_list = Column(JSON, unique=False)
     current_limssession = Column(JSON, unique=False)
     limsdata = Column(JSON, unique=False)
@@ -5,12 +5,16 @@
 
 
 import os
+import sqlite3
 import time
 
 import pytest
 
 import mxcubeweb
 import mxcubecore
+from sqlalchemy import text
+
+from mxcubeweb.core.components.user.database import init_db
 
 URL_BASE = "/mxcube/api/v0.1/login"
 URL_SIGNIN = f"{URL_BASE}/"  # Trailing slash is necessary
@@ -74,6 +78,33 @@ def client(make_client):
     return make_client()
 
 
+@pytest.fixture
+def usermanager(server):
+    return mxcubeweb.mxcube.usermanager
+
+
+@pytest.fixture
+def expired_users(server, make_client, usermanager):
+    """Two users of the same proposal, with socketio session ids `sid-0`
+    and `sid-1`, whose sessions have expired.
+    """
+    for _ in range(2):
+        client = make_client()
+        client.post(URL_SIGNIN, json=CREDENTIALS_0)
+        # Sets the last request timestamp of the user
+        client.get(URL_INFO)
+
+    with server.flask.test_request_context():
+        users = [usermanager.get_operator()] + usermanager.get_observers()
+
+        for idx, user in enumerate(users):
+            user.socketio_session_id = f"sid-{idx}"
+            usermanager.update_user(user)
+
+    # Let the sessions expire
+    time.sleep(SESSION_LIFETIME * 1.5)
+
+
 def test_authn_signin_good_credentials(client):
     resp = client.post(URL_SIGNIN, json=CREDENTIALS_0)
     assert resp.status_code == 200
@@ -194,3 +225,245 @@ def test_authn_session_timeout(client):
     client.post(URL_SIGNIN, json=CREDENTIALS_0)
     resp = client.get(URL_INFO)
     assert resp.json["loggedIn"] == True, "We can not login again"
+
+
+# Test against proposal-based authentication only
+@pytest.mark.parametrize("login_type", ["proposal"], indirect=True)
+def test_authn_inactive_users_sweep_without_returning(
+    server, usermanager, expired_users, monkeypatch
+):
+    """Test logging out inactive users without `UPDATE ... RETURNING`.
+
+    SQLite versions older than 3.35 do not support `RETURNING`, all inactive
+    users should be deactivated anyway.
+    """
+    dialect = server.db_session.get_bind().dialect
+    monkeypatch.setattr(dialect, "update_returning", False)
+
+    with server.flask.test_request_context():
+        usermanager.update_active_users()
+        assert usermanager.has_active_users() == False
+
+
+# Test against proposal-based authentication only
+@pytest.mark.parametrize("login_type", ["proposal"], indirect=True)
+def test_authn_set_operator(server, make_client, usermanager):
+    """Test handing over control with `set_operator`.
+
+    The new operator should be the only user in control.
+    """
+    client_0 = make_client()
+    client_0.post(URL_SIGNIN, json=CREDENTIALS_0)
+    client_1 = make_client()
+    client_1.post(URL_SIGNIN, json=CREDENTIALS_0)
+
+    with server.flask.test_request_context():
+        operator = usermanager.get_operator()
+        (observer,) = usermanager.get_observers()
+        observer_username = observer.username
+
+        new_operator = usermanager.set_operator(observer_username)
+        assert new_operator.username == observer_username
+        assert usermanager.get_operator().username == observer_username
+        assert [_u.username for _u in usermanager.get_observers()] == [
+            operator.username
+        ]
+
+    resp = client_1.get(URL_INFO)
+    assert resp.json["user"]["inControl"] == True
+    resp = client_0.get(URL_INFO)
+    assert resp.json["user"]["inControl"] == False
+
+
+def test_authn_configured_roles_cache(server, usermanager, monkeypatch):
+    """Test that the cached configured roles follow the in-house users.
+
+    The roles are cached per user, the cache must be invalidated when the
+    session hands out a new list of in-house users.
+    """
+    session = mxcubecore.HardwareRepository.beamline.session
+
+    monkeypatch.setattr(session, "in_house_users", [])
+    assert "staff" not in usermanager._get_configured_roles("idtest0")
+
+    monkeypatch.setattr(session, "in_house_users", [("idtest", "0")])
+    assert "staff" in usermanager._get_configured_roles("idtest0")
+
+
+def test_authn_is_authenticated(server, client, usermanager):
+    """Test `is_authenticated` before and after authentication."""
+    with server.flask.test_request_context():
+        assert usermanager.is_authenticated() == False
+
+    with client:
+        client.post(URL_SIGNIN, json=CREDENTIALS_0)
+        client.get(URL_INFO)
+        assert usermanager.is_authenticated() == True
+
+
+# Test against proposal-based authentication only
+@pytest.mark.parametrize("login_type", ["proposal"], indirect=True)
+def test_authn_inactive_users_sweep(server, usermanager, expired_users, monkeypatch):
+    """Test logging out inactive users.
+
+    All inactive users are deactivated at once and notified with a single
+    `userChanged` event sent to their socketio rooms.
+    """
+    emitted = []
+    monkeypatch.setattr(
+        server, "emit", lambda *args, **kwargs: emitted.append((args, kwargs))
+    )
+
+    with server.flask.test_request_context():
+        usermanager.update_active_users()
+        assert usermanager.has_active_users() == False
+
+    user_changed = [kwargs for args, kwargs in emitted if args[0] == "userChanged"]
+    assert len(user_changed) == 1
+    assert sorted(user_changed[0]["to"]) == ["sid-0", "sid-1"]
+
+
+# Test against proposal-based authentication only
+@pytest.mark.parametrize("login_type", ["proposal"], indirect=True)
+def test_authn_login_info_operator_throttle(
+    server, make_client, usermanager, monkeypatch
+):
+    """Test that `login_info` only updates the operator when needed.
+
+    The operator is not re-evaluated on every `login_info` call, but it is
+    right after control was handed over to another user.
+    """
+    client_0 = make_client()
+    client_0.post(URL_SIGNIN, json=CREDENTIALS_0)
+    client_1 = make_client()
+    client_1.post(URL_SIGNIN, json=CREDENTIALS_0)
+
+    calls = []
+    update_operator = usermanager.update_operator
+
+    def _update_operator(*args, **kwargs):
+        calls.append(args)
+        return update_operator(*args, **kwargs)
+
+    monkeypatch.setattr(usermanager, "update_operator", _update_operator)
+
+    client_0.get(URL_INFO)
+    client_1.get(URL_INFO)
+    assert calls == []
+
+    with server.flask.test_request_context():
+        (observer,) = usermanager.get_observers()
+        usermanager.set_operator(observer.username)
+
+    client_1.get(URL_INFO)
+    assert len(calls) == 1
+
+
+# Test against proposal-based authentication only
+@pytest.mark.parametrize("login_type", ["proposal"], indirect=True)
+def test_authn_login_info_expired_operator(make_client):
+    """Test that an observer takes over when the operator session expired.
+
+    This should happen on the next `login_info`, even if the operator was
+    updated only recently.
+    """
+    client_0 = make_client()
+    client_0.post(URL_SIGNIN, json=CREDENTIALS_0)
+    client_0.get(URL_INFO)
+
+    time.sleep(SESSION_LIFETIME * 0.6)
+
+    client_1 = make_client()
+    client_1.post(URL_SIGNIN, json=CREDENTIALS_0)
+    resp = client_1.get(URL_INFO)
+    assert resp.json["user"]["inControl"] == False
+
+    # Let the session of the operator (only) expire
+    time.sleep(SESSION_LIFETIME * 0.6)
+
+    # Logs out the operator
+    client_1.get(URL_REFRESH)
+
+    resp = client_1.get(URL_INFO)
+    assert resp.json["user"]["inControl"] == True
+
+
+def test_authn_login_info_proposal_list_backfill(server, client, usermanager):
+    """Test `login_info` for users without a stored proposal list.
+
+    Users created before the proposal list was stored at login get it built
+    from their LIMS data, and stored.
+    """
+    client.post(URL_SIGNIN, json=CREDENTIALS_0)
+    proposal_list = client.get(URL_INFO).json["proposalList"]
+
+    with server.flask.test_request_context():
+        user = usermanager.get_operator()
+        user.proposal_list = None
+        usermanager.update_user(user)
+
+    resp = client.get(URL_INFO)
+    assert resp.json["proposalList"] == proposal_list
+
+    with server.flask.test_request_context():
+        assert usermanager.get_operator().proposal_list == proposal_list
+
+
+# Test against proposal-based authentication only
+@pytest.mark.parametrize("login_type", ["proposal"], indirect=True)
+def test_authn_proposal_prefix(server, client, usermanager):
+    """Test the same proposal check based on the stored proposal prefix.
+
+    Users of the proposal already logged in are not in conflict, users of
+    other proposals are, and users without a proposal prefix are ignored.
+    """
+    client.post(URL_SIGNIN, json=CREDENTIALS_0)
+
+    with server.flask.test_request_context():
+        user = usermanager.get_operator()
+        assert user.proposal_prefix == CREDENTIALS_0["proposal"]
+
+        assert not usermanager.has_active_non_inhouse_proposal_conflict(
+            CREDENTIALS_0["proposal"]
+        )
+        assert usermanager.has_active_non_inhouse_proposal_conflict(
+            CREDENTIALS_1["proposal"]
+        )
+
+        user.proposal_prefix = None
+        usermanager.update_user(user)
+
+        assert not usermanager.has_active_non_inhouse_proposal_conflict(
+            CREDENTIALS_1["proposal"]
+        )
+
+
+def test_authn_proposal_prefix_column_migration(tmp_path):
+    """Test adding the proposal prefix column to an existing database.
+
+    The column is added and filled in from the usernames of existing users.
+    """
+    db_path = tmp_path / "user.db"
+
+    conn = sqlite3.connect(db_path)
+    conn.execute(
+        'CREATE TABLE "user" (id INTEGER PRIMARY KEY, username VARCHAR,'
+        " active BOOLEAN, in_control BOOLEAN, last_request_timestamp DATETIME)"
+    )
+    conn.executemany(
+        'INSERT INTO "user" (username) VALUES (?)',
+        [
+            ("idtest0-0123456789abcdef0123456789abcdef",),
+            ("idtest0-01234567-89ab-cdef-0123-456789abcdef",),
+            ("idtest1",),
+        ],
+    )
+    conn.commit()
+    conn.close()
+
+    db_session = init_db(db_path)
+    rows = db_session.execute(
+        text('SELECT proposal_prefix FROM "user" ORDER BY id')
+    ).scalars()
+    assert list(rows) == ["idtest0", "idtest0", "idtest1"]
+    db_session.remove()